@@ -1,50 +1,64 @@
 """The file holding client connection patterns for noteable APIs."""
 
+from __future__ import annotations
+
 import asyncio
 import functools
 import os
-from asyncio import Future
-from collections import defaultdict
-from datetime import datetime
-from queue import LifoQueue
-from typing import Optional, Type, Union
+import sys
+from datetime import datetime, timedelta, timezone
+from typing import TYPE_CHECKING, List, Optional, Tuple, Type, Union
 from uuid import UUID, uuid4
 
 import httpx
-import jwt
+import orjson
 import structlog
-import websockets
-from pydantic import BaseModel, BaseSettings, ValidationError
+from pydantic import BaseModel, BaseSettings
+from pydantic.json import pydantic_encoder
 
 from .types.deltas import FileDeltaAction, FileDeltaType, V2CellContentsProperties
 from .types.files import NotebookFile
 from .types.kernels import SessionRequestDetails
-from .types.rtu import (
-    RTU_ERROR_HARD_MESSAGE_TYPES,
-    RTU_MESSAGE_TYPES,
-    AuthenticationReply,
-    AuthenticationRequest,
-    AuthenticationRequestData,
-    CallbackTracker,
-    CellContentsDeltaReply,
-    CellStateMessageReply,
-    FileSubscribeReplySchema,
-    GenericRTUMessage,
-    GenericRTUReply,
-    GenericRTUReplySchema,
-    GenericRTURequest,
-    GenericRTURequestSchema,
-    KernelStatusUpdate,
-    MinimalErrorSchema,
-    PingReply,
-    PingRequest,
-    RTUEventCallable,
-    TopicActionReplyData,
-)
+
+# The RTU schemas, jwt and websockets are imported where they're used, so that scripts which only
+# need the config models or REST calls don't pay their import cost
+if TYPE_CHECKING:
+    from .types.rtu import (
+        CallbackTracker,
+        GenericRTURequestSchema,
+        KernelStatusUpdate,
+        RTUEventCallable,
+    )
 
 logger = structlog.get_logger('noteable.' + __name__)
 
 
+@functools.lru_cache(maxsize=None)
+def _rtu():
+    """Imports the RTU schemas on first use, returning the already bound module afterwards."""
+    from .types import rtu
+
+    return rtu
+
+
+# Keep a deep pool of long lived connections so concurrent REST calls don't pay a handshake each.
+# The keepalive expiry matches the nginx server default of 75 seconds.
+DEFAULT_LIMITS = httpx.Limits(
+    max_connections=1000, max_keepalive_connections=100, keepalive_expiry=75.0
+)
+
+# Skip per-message deflate and use larger buffers, cell content deltas can carry large sources
+DEFAULT_WS_OPTIONS = {
+    'compression': None,
+    'max_size': 8 * 1024 * 1024,
+    'read_limit': 2**20,
+    'write_limit': 2**20,
+}
+
+# Shared empty result for dispatch lookups that find no registered trackers
+NO_TRACKERS = ()
+
+
 class SkipCallback(ValueError):
     """Used to allow a message handler to gracefully skip processing and not be counted as a match"""
 
@@ -57,6 +71,22 @@ class ClientSettings(BaseSettings):
     auth0_config_path: str = "./auth0_config"
 
 
+def install_uvloop() -> bool:
+    """Installs uvloop as the asyncio event loop policy, returning whether it could be installed.
+
+    The client is bound by event loop scheduling, so applications can opt into the faster loop by
+    calling this before starting their event loop. Nothing is changed if uvloop isn't available.
+    """
+    if sys.platform == 'win32':
+        return False
+    try:
+        import uvloop
+    except ImportError:
+        return False
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
 class ClientConfig(BaseModel):
     """Captures the client's config object for user settable arguments"""
 
@@ -69,6 +99,10 @@ class ClientConfig(BaseModel):
     ws_timeout: int = 10
 
 
+# Tokens are refreshed this long before they expire
+TOKEN_EXPIRY_LEEWAY = timedelta(seconds=60)
+
+
 class Token(BaseModel):
     """Represents an oauth token response object"""
 
@@ -81,31 +115,22 @@ class Token(BaseModel):
     azp: str = None
     gty: str = None
 
+    @property
+    def is_expired(self) -> bool:
+        """Indicates if the token is within TOKEN_EXPIRY_LEEWAY of its expiration, so it isn't handed
+        out moments before it stops being accepted. Tokens without an expiration are treated as expired.
+        """
+        return self.exp is None or self.exp - TOKEN_EXPIRY_LEEWAY <= datetime.now(timezone.utc)
 
-class NoteableClient(httpx.AsyncClient):
-    """An async client class that provides interfaces for communicating with Noteable APIs."""
-
-    def _requires_ws_context(func):
-        """A helper for checking if one is in a websocket context or not"""
-
-        @functools.wraps(func)
-        async def wrapper(self, *args, **kwargs):
-            if not self.in_context:
-                raise ValueError("Cannot send RTU request outside of a context manager scope.")
-            return await func(self, *args, **kwargs)
-
-        return wrapper
 
-    def _default_timeout_arg(func):
-        """A helper for checking if one is in a websocket context or not"""
+# (auth0_domain, client_id, audience) -> Token, shared by all clients until the token expires
+TOKEN_CACHE = {}
+# (auth0_domain, client_id, audience) -> in-flight token fetch, so clients entering together share it
+TOKEN_FETCHES = {}
 
-        @functools.wraps(func)
-        async def wrapper(self, *args, timeout=None, **kwargs):
-            if timeout is None:
-                timeout = self.config.ws_timeout
-            return await func(self, *args, timeout=timeout, **kwargs)
 
-        return wrapper
+class NoteableClient(httpx.AsyncClient):
+    """An async client class that provides interfaces for communicating with Noteable APIs."""
 
     def __init__(
         self,
@@ -127,50 +152,72 @@ class NoteableClient(httpx.AsyncClient):
                 config = ClientConfig.parse_file(settings.auth0_config_path)
         self.config = config
         self.file_session_cache = {}
+        # URIs derived from the domain are built once rather than formatted on every request
+        self.origin = f'https://{self.config.domain}'
+        self.api_server_uri = f"{self.origin}/gate/api"
+        self.files_uri = f"{self.api_server_uri}/files/"
+        self.sessions_uri = f"{self.api_server_uri}/sessions"
 
         self.user = None
-        self.token = api_token or self.get_token()
+        # When no token is given one is fetched on context entry
+        self.token = api_token
         if isinstance(self.token, str):
             self.token = Token(access_token=api_token)
         self.rtu_socket = None
         self.process_task_loop = None
 
         headers = kwargs.pop('headers', {})
-        headers['Authorization'] = f"Bearer {self.token.access_token}"
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token.access_token}"
 
         # Set of active channel subscriptions (always subscribed to system messages)
         self.subscriptions = {'system'}
-        # channel -> message_type -> callback_queue
-        self.type_callbacks = defaultdict(lambda: defaultdict(LifoQueue))
-        # channel -> transaction_id -> callback_queue
-        self.transaction_callbacks = defaultdict(lambda: defaultdict(LifoQueue))
+        # (channel, message_type) -> trackers
+        self.type_callbacks = {}
+        # (channel, transaction_id) -> trackers
+        self.transaction_callbacks = {}
         super().__init__(
-            base_url=f"https://{self.config.domain}/",
+            base_url=f"{self.origin}/",
             follow_redirects=follow_redirects,
             headers=headers,
+            limits=kwargs.pop('limits', DEFAULT_LIMITS),
             **kwargs,
         )
 
-    @property
-    def origin(self):
-        """Formats the domain in an origin string for websocket headers."""
-        return f'https://{self.config.domain}'
-
     @property
     def ws_uri(self):
         """Formats the websocket URI out of the notable domain name."""
         return f"wss://{self.config.domain}/gate/api/v1/rtu"
 
-    @property
-    def api_server_uri(self):
-        """Formats the websocket URI out of the notable domain name."""
-        return f"https://{self.config.domain}/gate/api"
-
-    def get_token(self):
+    async def get_token(self):
         """Fetches and api token using oauth client config settings.
 
-        WARNING: This is a blocking call so we can call it from init, but it should be quick
+        The request is made asynchronously rather than blocking the event loop, and the resulting
+        token is shared with other clients using the same oauth settings.
         """
+        cache_key = (self.config.auth0_domain, self.config.client_id, self.config.audience)
+        cached = TOKEN_CACHE.get(cache_key)
+        if cached and not cached.is_expired:
+            return cached
+
+        fetch = TOKEN_FETCHES.get(cache_key)
+        # A fetch left behind by another event loop can't be awaited from this one
+        if fetch is None or fetch.get_loop() is not asyncio.get_running_loop():
+            fetch = asyncio.ensure_future(self._fetch_token(cache_key))
+            TOKEN_FETCHES[cache_key] = fetch
+
+            def forget_fetch(done: asyncio.Future):
+                if TOKEN_FETCHES.get(cache_key) is done:
+                    del TOKEN_FETCHES[cache_key]
+
+            fetch.add_done_callback(forget_fetch)
+        # Shielded so one cancelled caller doesn't cancel the fetch for the others waiting on it
+        return await asyncio.shield(fetch)
+
+    async def _fetch_token(self, cache_key: Tuple[str, str, str]) -> Token:
+        """Requests a new api token from the oauth domain and caches it under the given key."""
+        import jwt
+
         url = f"https://{self.config.auth0_domain}/oauth/token"
         data = {
             "client_id": self.config.client_id,
@@ -178,16 +225,19 @@ class NoteableClient(httpx.AsyncClient):
             "audience": self.config.audience,
             "grant_type": "client_credentials",
         }
-        resp = httpx.post(url, json=data)
+        # Use a bare client so none of this client's default headers are sent to the auth domain
+        async with httpx.AsyncClient() as auth_client:
+            resp = await auth_client.post(url, json=data)
         resp.raise_for_status()
 
         token = resp.json()["access_token"]
         token_data = jwt.decode(token, options={"verify_signature": False})
-        return Token(access_token=token, **token_data)
+        TOKEN_CACHE[cache_key] = Token(access_token=token, **token_data)
+        return TOKEN_CACHE[cache_key]
 
     async def get_notebook(self, file_id) -> NotebookFile:
         """Fetches a notebook file via the Noteable REST API as a NotebookFile model (see files.py)"""
-        resp = await self.get(f"{self.api_server_uri}/files/{file_id}")
+        resp = await self.get(self.files_uri + str(file_id))
         resp.raise_for_status()
         return NotebookFile.parse_raw(resp.content)
 
@@ -197,12 +247,14 @@ class NoteableClient(httpx.AsyncClient):
         """Fetches the first notebook kernel session via the Noteable REST API.
         Returns None if no session is active.
         """
+        rtu = _rtu()
+
         file_id = file if not isinstance(file, NotebookFile) else file.id
-        resp = await self.get(f"{self.api_server_uri}/files/{file_id}/sessions")
+        resp = await self.get(self.files_uri + str(file_id) + "/sessions")
         resp.raise_for_status()
         resp_data = resp.json()
         if resp_data:
-            session = KernelStatusUpdate(
+            session = rtu.KernelStatusUpdate(
                 session_id=resp_data[0]["id"], kernel=resp_data[0]["kernel"]
             )
             self.file_session_cache[file_id] = session
@@ -215,14 +267,16 @@ class NoteableClient(httpx.AsyncClient):
         hardware_size: Optional[str] = None,
     ) -> KernelStatusUpdate:
         """Requests that a notebook session be launched via the Noteable REST API"""
+        rtu = _rtu()
+
         request = SessionRequestDetails.generate_file_request(
             file, kernel_name=kernel_name, hardware_size=hardware_size
         )
         # Needs the .dict conversion to avoid thinking it's an object with a synchronous byte stream
-        resp = await self.post(f"{self.api_server_uri}/sessions", data=request.json())
+        resp = await self.post(self.sessions_uri, data=request.json())
         resp.raise_for_status()
         resp_data = resp.json()
-        session = KernelStatusUpdate(session_id=resp_data["id"], kernel=resp_data["kernel"])
+        session = rtu.KernelStatusUpdate(session_id=resp_data["id"], kernel=resp_data["kernel"])
         self.file_session_cache[file.id] = session
         return session
 
@@ -237,6 +291,8 @@ class NoteableClient(httpx.AsyncClient):
         If no session is available one is created, if one is available but not ready it awaits the kernel session
         being ready for further requests.
         """
+        rtu = _rtu()
+
         resp = await self.subscribe_file(file)
         assert resp.data.success, "Failed to connect to the files channel over RTU"
         session = resp.data.kernel_session
@@ -264,18 +320,21 @@ class NoteableClient(httpx.AsyncClient):
                     kernel_status_update = await asyncio.wait_for(
                         kernel_status_tracker_future, timeout=launch_timeout
                     )
-                session = KernelStatusUpdate.parse_obj(kernel_status_update.data)
+                session = rtu.KernelStatusUpdate.parse_obj(kernel_status_update.data)
 
         if session:
             self.file_session_cache[file.id] = session
 
         return session
 
-    @_default_timeout_arg
-    async def delete_kernel_session(self, file: Union[UUID, NotebookFile], timeout: float = None):
+    async def delete_kernel_session(
+        self, file: Union[UUID, NotebookFile], timeout: Optional[float] = None
+    ):
         """Fetches the first notebook kernel session via the Noteable REST API.
         Returns None if no session is active.
         """
+        if timeout is None:
+            timeout = self.config.ws_timeout
         file_id = file if not isinstance(file, NotebookFile) else file.id
         if file_id in self.file_session_cache:
             session = self.file_session_cache[file_id]
@@ -283,9 +342,7 @@ class NoteableClient(httpx.AsyncClient):
             session = await self.get_kernel_session(file)
         if session is None:
             return  # Already shutdown
-        resp = await self.delete(
-            f"{self.api_server_uri}/sessions/{session.session_id}", timeout=timeout
-        )
+        resp = await self.delete(self.sessions_uri + "/" + str(session.session_id), timeout=timeout)
         resp.raise_for_status()
         if file_id in self.file_session_cache:
             del self.file_session_cache[file.id]
@@ -304,10 +361,17 @@ class NoteableClient(httpx.AsyncClient):
         JWT format and the verify_jwt_token Security function would
         validate and extract principal-user-id from the token.
         """
+        import websockets
+
         res = await httpx.AsyncClient.__aenter__(self)
+        if self.token is None:
+            self.token = await self.get_token()
+            self.headers['Authorization'] = f"Bearer {self.token.access_token}"
         # Origin is needed, else the server request crashes and rejects the connection
         headers = {'Authorization': self.headers['authorization'], 'Origin': self.origin}
-        self.rtu_socket = await websockets.connect(self.ws_uri, extra_headers=headers)
+        self.rtu_socket = await websockets.connect(
+            self.ws_uri, extra_headers=headers, **DEFAULT_WS_OPTIONS
+        )
         # Loop indefinitely over the incoming websocket messages
         self.process_task_loop = asyncio.create_task(self._process_messages())
         # Authenticate for more advanced API calls
@@ -323,11 +387,11 @@ class NoteableClient(httpx.AsyncClient):
             if self.rtu_socket:
                 await self.rtu_socket.close()
                 self.rtu_socket = None
-            self.subscriptions = {'system'}
-            # channel -> message_type -> callback_queue
-            self.type_callbacks = defaultdict(lambda: defaultdict(LifoQueue))
-            # channel -> transaction_id -> callback_queue
-            self.transaction_callbacks = defaultdict(lambda: defaultdict(LifoQueue))
+            # Reset the trackers in place rather than allocating new containers
+            self.subscriptions.clear()
+            self.subscriptions.add('system')
+            self.type_callbacks.clear()
+            self.transaction_callbacks.clear()
         except Exception:
             logger.exception("Error in closing out nested context loops")
         finally:
@@ -350,34 +414,44 @@ class NoteableClient(httpx.AsyncClient):
         The once flag will indicate this callback should only be used for the next
         event trigger (default True).
         """
-        tracker = CallbackTracker(
+        rtu = _rtu()
+        # Bind what the dispatch path uses so each message doesn't look it up on the module
+        error_types, message_types = rtu.RTU_ERROR_HARD_MESSAGE_TYPES, rtu.RTU_MESSAGE_TYPES
+        GenericRTUReply, GenericRTURequest = rtu.GenericRTUReply, rtu.GenericRTURequest
+
+        # Futures are bound to the running loop directly rather than looked up on each construction
+        loop = asyncio.get_running_loop()
+        tracker = rtu.CallbackTracker(
             once=once,
             count=0,
             callable=callable,
             channel=channel,
             message_type=message_type,
             transaction_id=transaction_id,
-            next_trigger=Future(),
+            next_trigger=loop.create_future(),
             response_schema=response_schema,
         )
 
-        async def wrapped_callable(resp: GenericRTUMessage):
-            """Wraps the user callback function to handle message parsing and future triggers."""
+        async def wrapped_callable(payload: dict):
+            """Wraps the user callback function to handle message parsing and future triggers.
+
+            The raw message payload is validated exactly once, against the most specific schema known.
+            """
             skipped = False
             failed = False
-            if resp.event in RTU_ERROR_HARD_MESSAGE_TYPES:
-                resp = MinimalErrorSchema.parse_obj(resp)
+            if payload['event'] in error_types:
+                resp = rtu.MinimalErrorSchema.parse_obj(payload)
                 msg = resp.data['message']
                 logger.exception(f"Request failed: {msg}")
                 # TODO: Different exception class?
                 tracker.next_trigger.set_exception(ValueError(msg))
             else:
-                if tracker.response_schema:
-                    resp = tracker.response_schema.parse_obj(resp)
-                elif tracker.message_type in RTU_MESSAGE_TYPES:
-                    resp = RTU_MESSAGE_TYPES[tracker.message_type].parse_obj(resp)
-
                 try:
+                    schema = tracker.response_schema or message_types.get(tracker.message_type)
+                    if schema is None:
+                        # Only replies carry a server injected msg_id, so there's no need to try both
+                        schema = GenericRTUReply if 'msg_id' in payload else GenericRTURequest
+                    resp = schema.parse_obj(payload)
                     result = await callable(resp)
                     tracker.count += 1
                     tracker.next_trigger.set_result(result)
@@ -392,102 +466,137 @@ class NoteableClient(httpx.AsyncClient):
             if skipped or not tracker.once:
                 # Reset the next trigger promise
                 if not skipped:
-                    tracker.next_trigger = Future()
+                    tracker.next_trigger = loop.create_future()
                 if tracker.transaction_id:
-                    self.transaction_callbacks[tracker.channel][tracker.transaction_id].put_nowait(
-                        tracker
-                    )
+                    self.transaction_callbacks.setdefault(
+                        (tracker.channel, tracker.transaction_id), []
+                    ).append(tracker)
                 else:
-                    self.type_callbacks[tracker.channel][tracker.message_type].put_nowait(tracker)
+                    self.type_callbacks.setdefault(
+                        (tracker.channel, tracker.message_type), []
+                    ).append(tracker)
             return not skipped and not failed
 
         # Replace the callable with a function that will manage itself and it's future awaitable
         tracker.callable = wrapped_callable
         if tracker.transaction_id:
-            self.transaction_callbacks[channel][transaction_id].put_nowait(tracker)
+            self.transaction_callbacks.setdefault((channel, transaction_id), []).append(tracker)
         else:
-            self.type_callbacks[channel][message_type].put_nowait(tracker)
+            self.type_callbacks.setdefault((channel, message_type), []).append(tracker)
         return tracker
 
+    def unregister_message_callback(self, tracker: CallbackTracker):
+        """Removes a registered callback tracker so it no longer consumes messages."""
+        if tracker.transaction_id:
+            registry, key = self.transaction_callbacks, (tracker.channel, tracker.transaction_id)
+        else:
+            registry, key = self.type_callbacks, (tracker.channel, tracker.message_type)
+        # Compare by identity, pydantic equality would compare every field
+        trackers = [t for t in registry.get(key, NO_TRACKERS) if t is not tracker]
+        if trackers:
+            registry[key] = trackers
+        else:
+            registry.pop(key, None)
+
     async def _process_messages(self):
         """Provides an infinite control loop for consuming RTU websocket messages.
 
-        The loop will parse the message, convert to a RTUReply or RTURequest,
-        log any validation errors (skipping callbacks), and finally identifying
-        any callbacks that are registered to consume the given message and pass
-        the message as the sole argument.
+        The loop will decode the message, log any malformed payloads (skipping
+        callbacks), and finally identify any callbacks that are registered to
+        consume the given message and pass the decoded payload as the sole
+        argument. Schema validation is left to the callbacks so that each message
+        is only validated once, and messages nobody listens for are not validated at all.
         """
+        from websockets.exceptions import ConnectionClosed
+
+        # Localize the callback registries for the hot loop
+        type_cbs = self.type_callbacks
+        transaction_cbs = self.transaction_callbacks
         while True:
-            # Release context control at the start of each loop
+            # Release context control at the start of each loop. recv() returns buffered frames
+            # without suspending, so this is the only guaranteed yield under a busy stream.
             await asyncio.sleep(0)
             try:
                 msg = await self.rtu_socket.recv()
-                if not isinstance(msg, str):
+                # orjson decodes utf-8 bytes directly, so binary frames need no str conversion
+                if not isinstance(msg, (str, bytes)):
                     logger.exception(f"Unexpected message type found on socket: {type(msg)}")
                     continue
                 try:
-                    res = GenericRTUReply.parse_raw(msg)
-                    channel = res.channel
-                    event = res.event
-                except ValidationError:
-                    try:
-                        res = GenericRTURequest.parse_raw(msg)
-                        channel = res.channel
-                        event = res.event
-                    except ValidationError:
-                        logger.exception(
-                            f"Unexpected message found on socket: {msg[:30]}{'...' if len(msg) > 30 else ''}"
-                        )
-                        continue
-
-                logger.debug(f"Received websocket message: {res}")
+                    payload = orjson.loads(msg)
+                    # Mirror the lowercasing the RTU schema validators apply
+                    channel = payload['channel'] = payload['channel'].lower()
+                    event = payload['event'] = payload['event'].lower()
+                    transaction_id = payload.get('transaction_id')
+                    if transaction_id is not None:
+                        transaction_id = UUID(transaction_id)
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    logger.exception(
+                        f"Unexpected message found on socket: {msg[:30]}{'...' if len(msg) > 30 else ''}"
+                    )
+                    continue
+
+                logger.debug(f"Received websocket message: {payload}")
                 # Check for transaction id responses
-                id_lifo = self.transaction_callbacks[channel][res.transaction_id]
-                # Pull all the trackers out initially so that re-registering trackers don't get rerun this cycle
-                trackers = []
-                while not id_lifo.empty():
-                    trackers.append(id_lifo.get(block=False))
-                for tracker in trackers:
+                # Popping swaps the whole tracker list out at once, so trackers (re-)registered while
+                # callbacks run land in a fresh list and only match the next message.
+                # Lookups never allocate for channels or keys without any callbacks
+                trackers = transaction_cbs.pop((channel, transaction_id), NO_TRACKERS)
+                # Most recently registered trackers run first
+                for tracker in reversed(trackers):
                     logger.debug(f"Found callable for {channel}/{tracker.transaction_id}")
-                    processed = await tracker.callable(res)
+                    processed = await tracker.callable(payload)
                     logger.debug(
                         f"Callable for {channel}/{tracker.transaction_id} was a "
                         f"{'successful' if processed else 'failed'} match"
                     )
 
                 # Check for general event callbacks
-                type_lifo = self.type_callbacks[channel][event]
-                # Pull all the trackers out initially so that re-registering trackers don't get rerun this cycle
-                trackers = []
-                while not type_lifo.empty():
-                    trackers.append(type_lifo.get(block=False))
-                for tracker in trackers:
+                trackers = type_cbs.pop((channel, event), NO_TRACKERS)
+                for tracker in reversed(trackers):
                     logger.debug(f"Found callable for {channel}/{event}")
-                    processed = await tracker.callable(res)
+                    processed = await tracker.callable(payload)
                     logger.debug(
                         f"Callable for {channel}/{event} was a {'successful' if processed else 'failed'} match"
                     )
 
-            except websockets.exceptions.ConnectionClosed:
-                await asyncio.sleep(0)
+            except ConnectionClosed:
                 break
             except Exception:
                 logger.exception("Unexpected callback failure")
-                await asyncio.sleep(0)
                 break
 
-    @_requires_ws_context
     async def send_rtu_request(self, req: GenericRTURequestSchema):
-        """Wraps converting a pydantic request model to be send down the websocket."""
+        """Wraps converting a pydantic request model to be sent down the websocket."""
+        if self.rtu_socket is None:
+            raise ValueError("Cannot send RTU request outside of a context manager scope.")
         logger.debug(f"Sending websocket request: {req}")
-        return await self.rtu_socket.send(req.json())
+        # orjson is much faster than the stdlib json encoder pydantic uses for .json()
+        return await self.rtu_socket.send(
+            orjson.dumps(req.dict(), default=pydantic_encoder).decode()
+        )
 
-    @_requires_ws_context
-    @_default_timeout_arg
-    async def authenticate(self, timeout: float):
+    async def _send_tracked_rtu_request(
+        self, req: GenericRTURequestSchema, *trackers: CallbackTracker
+    ):
+        """Sends a request whose replies the given trackers are waiting on, unregistering the
+        trackers if the request can't be sent so they aren't left behind.
+        """
+        try:
+            await self.send_rtu_request(req)
+        except BaseException:
+            for tracker in trackers:
+                self.unregister_message_callback(tracker)
+            raise
+
+    async def authenticate(self, timeout: Optional[float] = None):
         """Authenticates a fresh websocket as the given user."""
+        rtu = _rtu()
+
+        if timeout is None:
+            timeout = self.config.ws_timeout
 
-        async def authorized(resp: AuthenticationReply):
+        async def authorized(resp: rtu.AuthenticationReply):
             if resp.data.success:
                 logger.debug("User is authenticated!")
                 self.user = resp.data.user
@@ -496,28 +605,31 @@ class NoteableClient(httpx.AsyncClient):
             return resp
 
         # Register the transaction reply after sending the request
-        req = AuthenticationRequest(
-            transaction_id=uuid4(), data=AuthenticationRequestData(token=self.token.access_token)
+        req = rtu.AuthenticationRequest(
+            transaction_id=uuid4(),
+            data=rtu.AuthenticationRequestData(token=self.token.access_token),
         )
-        tracker = AuthenticationReply.register_callback(self, req, authorized)
-        await self.send_rtu_request(req)
+        tracker = rtu.AuthenticationReply.register_callback(self, req, authorized)
+        await self._send_tracked_rtu_request(req, tracker)
         # Give it timeout seconds to respond
         return await asyncio.wait_for(tracker.next_trigger, timeout)
 
-    @_requires_ws_context
-    @_default_timeout_arg
-    async def ping_rtu(self, timeout: float):
+    async def ping_rtu(self, timeout: Optional[float] = None):
         """Sends a ping request to the RTU websocket and confirms the response is valid."""
+        rtu = _rtu()
 
-        async def pong(resp: GenericRTUReply):
+        if timeout is None:
+            timeout = self.config.ws_timeout
+
+        async def pong(resp: rtu.GenericRTUReply):
             """The pong response for pinging a webrowser"""
             logger.debug("Initial ping response received! Websocket is live.")
             return resp  # Do nothing, we just want to ensure we reach the event
 
         # Register the transaction reply after sending the request
-        req = PingRequest(transaction_id=uuid4())
-        tracker = PingReply.register_callback(self, req, pong)
-        await self.send_rtu_request(req)
+        req = rtu.PingRequest(transaction_id=uuid4())
+        tracker = rtu.PingReply.register_callback(self, req, pong)
+        await self._send_tracked_rtu_request(req, tracker)
         # Give it timeout seconds to respond
         pong_resp = await asyncio.wait_for(tracker.next_trigger, timeout)
         # These should be consistent, but validate for good measure
@@ -527,7 +639,9 @@ class NoteableClient(httpx.AsyncClient):
         return pong_resp
 
     def _gen_subscription_request(self, channel: str):
-        async def process_subscribe(resp: GenericRTUReplySchema[TopicActionReplyData]):
+        rtu = _rtu()
+
+        async def process_subscribe(resp: rtu.GenericRTUReplySchema[rtu.TopicActionReplyData]):
             if resp.data.success:
                 self.subscriptions.add(resp.channel)
             else:
@@ -539,35 +653,38 @@ class NoteableClient(httpx.AsyncClient):
             process_subscribe,
             channel,
             transaction_id=uuid4(),
-            response_schema=GenericRTUReplySchema[TopicActionReplyData],
+            response_schema=rtu.GenericRTUReplySchema[rtu.TopicActionReplyData],
         )
-        req = GenericRTURequest(
+        req = rtu.GenericRTURequest(
             transaction_id=tracker.transaction_id, event="subscribe_request", channel=channel
         )
         return req, tracker
 
-    @_requires_ws_context
-    @_default_timeout_arg
-    async def subscribe_channel(self, channel: str, timeout: float):
+    async def subscribe_channel(self, channel: str, timeout: Optional[float] = None):
         """A generic pattern for subscribing to topic channels."""
+        if timeout is None:
+            timeout = self.config.ws_timeout
         req, tracker = self._gen_subscription_request(channel)
-        await self.send_rtu_request(req)
+        await self._send_tracked_rtu_request(req, tracker)
         return await asyncio.wait_for(tracker.next_trigger, timeout)
 
     @staticmethod
+    @functools.lru_cache(maxsize=256)
     def files_channel(file_id):
         """Helper to build file channel names from file ids"""
         return f"files/{file_id}"
 
-    @_requires_ws_context
-    @_default_timeout_arg
     async def subscribe_file(
         self,
         file: Union[UUID, NotebookFile],
-        timeout: float,
+        timeout: Optional[float] = None,
         from_version_id: Optional[UUID] = None,
     ):
         """Subscribes to a specified file for updates about it's contents."""
+        rtu = _rtu()
+
+        if timeout is None:
+            timeout = self.config.ws_timeout
         if isinstance(file, NotebookFile):
             # TODO: Write test for file
             file_id = file.id
@@ -579,7 +696,7 @@ class NoteableClient(httpx.AsyncClient):
             from_version_id = file.current_version_id
         channel = self.files_channel(file_id)
         req, tracker = self._gen_subscription_request(channel)
-        tracker.response_schema = FileSubscribeReplySchema
+        tracker.response_schema = rtu.FileSubscribeReplySchema
         # TODO: write test for these fields
         req.data = {}
         if from_version_id:
@@ -588,34 +705,80 @@ class NoteableClient(httpx.AsyncClient):
         # if from_delta_id:
         #     req.data['from_delta_id'] = from_delta_id
 
-        await self.send_rtu_request(req)
+        await self._send_tracked_rtu_request(req, tracker)
         return await asyncio.wait_for(tracker.next_trigger, timeout)
 
-    @_requires_ws_context
-    @_default_timeout_arg
     async def replace_cell_contents(
-        self, file: NotebookFile, cell_id: str, contents: str, timeout: float
+        self, file: NotebookFile, cell_id: str, contents: str, timeout: Optional[float] = None
     ):
         """Sends an RTU request to replace the contents of a particular cell in a particular file."""
+        (resp,) = await self.replace_cells(file, [(cell_id, contents)], timeout)
+        if isinstance(resp, BaseException):
+            raise resp
+        return resp
 
-        async def check_success(resp: GenericRTUReplySchema[TopicActionReplyData]):
-            if not resp.data.success:
-                logger.error(f"Failed to submit cell change for file {file.id} -> {cell_id}")
-            return resp
+    async def replace_cells(
+        self,
+        file: NotebookFile,
+        updates: List[Tuple[str, str]],
+        timeout: Optional[float] = None,
+    ):
+        """Sends RTU requests to replace the contents of several cells in a particular file.
 
-        req = file.generate_delta_request(
-            uuid4(),
-            FileDeltaType.cell_contents,
-            FileDeltaAction.replace,
-            cell_id,
-            properties=V2CellContentsProperties(source=contents),
-        )
-        tracker = CellContentsDeltaReply.register_callback(self, req, check_success)
-        await self.send_rtu_request(req)
-        return await asyncio.wait_for(tracker.next_trigger, timeout)
+        The updates are (cell_id, contents) pairs. A delta request only holds a single cell change, so
+        every request is sent before any reply is awaited, costing one round trip instead of one per cell.
+
+        Returns one entry per update, in order: the cell's reply, or the exception its reply failed
+        or timed out with, so callers can tell which cells were applied. Failed writes are raised.
+        """
+        rtu = _rtu()
+
+        if timeout is None:
+            timeout = self.config.ws_timeout
+
+        def check_success_for(cell_id: str):
+            async def check_success(resp: rtu.GenericRTUReplySchema[rtu.TopicActionReplyData]):
+                if not resp.data.success:
+                    logger.error(f"Failed to submit cell change for file {file.id} -> {cell_id}")
+                return resp
+
+            return check_success
+
+        trackers = []
+        try:
+            reqs = []
+            for cell_id, contents in updates:
+                req = file.generate_delta_request(
+                    uuid4(),
+                    FileDeltaType.cell_contents,
+                    FileDeltaAction.replace,
+                    cell_id,
+                    properties=V2CellContentsProperties(source=contents),
+                )
+                trackers.append(
+                    rtu.CellContentsDeltaReply.register_callback(
+                        self, req, check_success_for(cell_id)
+                    )
+                )
+                reqs.append(req)
+            # Write every request before awaiting any reply, raising the first failed write
+            # rather than waiting out the timeout on its reply
+            sends = await asyncio.gather(
+                *[self.send_rtu_request(req) for req in reqs], return_exceptions=True
+            )
+            for result in sends:
+                if isinstance(result, BaseException):
+                    raise result
+            # Every wait finishes before returning, so none outlive the call on a failed reply
+            return await asyncio.gather(
+                *[asyncio.wait_for(tracker.next_trigger, timeout) for tracker in trackers],
+                return_exceptions=True,
+            )
+        finally:
+            # Triggered trackers are already gone, this drops any left waiting after a failure
+            for tracker in trackers:
+                self.unregister_message_callback(tracker)
 
-    @_requires_ws_context
-    @_default_timeout_arg
     async def execute(
         self,
         file: NotebookFile,
@@ -623,13 +786,21 @@ class NoteableClient(httpx.AsyncClient):
         before_id: Optional[str] = None,
         after_id: Optional[str] = None,
         await_results: bool = True,
-        timeout: float = None,  # Wrapper sets the for us so the type hint is correct
+        timeout: Optional[float] = None,
     ):
         """Sends an RTU request to execute a part of the Notebook NotebookFile."""
+        rtu = _rtu()
+
+        if timeout is None:
+            timeout = self.config.ws_timeout
         assert not before_id or not after_id, 'Cannot define both a before_id and after_id'
         assert not cell_id or not after_id, 'Cannot define both a cell_id and after_id'
         assert not cell_id or not before_id, 'Cannot define both a cell_id and before_id'
 
+        assert (
+            not await_results or cell_id
+        ), "Haven't implemented awaiting results for batch execution yet, sorry"
+
         session = self.file_session_cache.get(file.id)
         assert (
             session and session.kernel.execution_state.kernel_is_alive
@@ -645,7 +816,7 @@ class NoteableClient(httpx.AsyncClient):
             action = FileDeltaAction.execute_after
             cell_id = after_id
 
-        async def check_success(resp: GenericRTUReply):
+        async def check_success(resp: rtu.GenericRTUReply):
             if resp.event != 'new_delta_reply':
                 raise SkipCallback("Looking for reply to request, not execution updates")
             data = resp.data or {}
@@ -658,11 +829,12 @@ class NoteableClient(httpx.AsyncClient):
         req = file.generate_delta_request(
             uuid4(), FileDeltaType.cell_execute, action, cell_id, None
         )
-        tracker = GenericRTUReply.register_callback(self, req, check_success)
+        tracker = rtu.GenericRTUReply.register_callback(self, req, check_success)
         tracker_future = tracker.next_trigger
+        trackers = [tracker]
         results_tracker_future = None
 
-        async def cell_complete_check(resp: CellStateMessageReply):
+        async def cell_complete_check(resp: rtu.CellStateMessageReply):
             if resp.data.cell_id != cell_id:
                 raise SkipCallback("Not tracked cell")
             if not resp.data.state.is_terminal_state:
@@ -670,19 +842,17 @@ class NoteableClient(httpx.AsyncClient):
             return resp
 
         if await_results:
-            assert (
-                action == FileDeltaAction.execute
-            ), "Haven't implemented awaiting results for batch execution yet, sorry"
             # Register this before we start execution so we don't miss fast cells concluding
             results_tracker = self.register_message_callback(
                 cell_complete_check,
                 session.kernel_channel,
                 "cell_state_update_event",
-                response_schema=CellStateMessageReply,
+                response_schema=rtu.CellStateMessageReply,
             )
             results_tracker_future = results_tracker.next_trigger
+            trackers.append(results_tracker)
 
-        await self.send_rtu_request(req)
+        await self._send_tracked_rtu_request(req, *trackers)
         if tracker_future.done():
             execute_resp = tracker_future.result()
         else:
@@ -1,20 +1,40 @@
 """Tests for the async noteable client calls."""
 
+import asyncio
 import json
-from datetime import datetime
-from unittest.mock import AsyncMock, patch
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, Mock, patch
 from uuid import UUID, uuid4
 
+import httpx
 import pytest
 import pytest_asyncio
+from pydantic import ValidationError
+from websockets.exceptions import ConnectionClosedError
 
-from ..client import ClientConfig, NoteableClient
+from ..client import (
+    DEFAULT_LIMITS,
+    DEFAULT_WS_OPTIONS,
+    TOKEN_CACHE,
+    TOKEN_EXPIRY_LEEWAY,
+    TOKEN_FETCHES,
+    ClientConfig,
+    NoteableClient,
+    Token,
+    install_uvloop,
+)
+from ..types.files import NotebookFile
 from ..types.rtu import (
     AuthenticationReply,
     FileSubscribeActionReplyData,
     FileSubscribeReplySchema,
     GenericRTUReply,
+    GenericRTURequest,
     PingReply,
+    PingRequest,
 )
 
 
@@ -62,13 +82,145 @@ async def client(connect_mock_with_auth_patched, client_config):
 async def test_client_websocket_context(connect_mock_with_auth_patched):
     async with NoteableClient('fake-token') as client:
         headers = {'Authorization': 'Bearer fake-token', 'Origin': client.origin}
-        connect_mock_with_auth_patched.assert_called_once_with(client.ws_uri, extra_headers=headers)
+        connect_mock_with_auth_patched.assert_called_once_with(
+            client.ws_uri, extra_headers=headers, **DEFAULT_WS_OPTIONS
+        )
         connect_mock_with_auth_patched.return_value.recv.assert_called()
         connect_mock_with_auth_patched.return_value.close.assert_not_called()
     connect_mock_with_auth_patched.return_value.recv.assert_called()
     connect_mock_with_auth_patched.return_value.close.assert_called_once()
 
 
+def test_install_uvloop():
+    uvloop = Mock()
+    with patch.dict(sys.modules, uvloop=uvloop), patch(
+        'asyncio.set_event_loop_policy'
+    ) as set_policy:
+        assert install_uvloop()
+    set_policy.assert_called_once_with(uvloop.EventLoopPolicy.return_value)
+
+
+@pytest.mark.parametrize(
+    'platform, uvloop', [('linux', None), ('win32', Mock())], ids=['not-installed', 'windows']
+)
+def test_install_uvloop_unavailable(platform, uvloop):
+    with patch.dict(sys.modules, uvloop=uvloop), patch.object(sys, 'platform', platform), patch(
+        'asyncio.set_event_loop_policy'
+    ) as set_policy:
+        assert not install_uvloop()
+    set_policy.assert_not_called()
+
+
+def test_import_keeps_default_event_loop_policy():
+    # Run in a fresh interpreter so the import isn't already cached
+    check = (
+        "import asyncio, sys, unittest.mock; sys.modules['uvloop'] = unittest.mock.Mock(); "
+        "import origami.client; "
+        "assert type(asyncio.get_event_loop_policy()) is asyncio.DefaultEventLoopPolicy"
+    )
+    repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    subprocess.run([sys.executable, '-c', check], check=True, cwd=repo_root)
+
+
+def test_client_connection_limits(client_config):
+    with patch.object(httpx.AsyncClient, '__init__', return_value=None) as client_init:
+        NoteableClient('fake-token', config=client_config)
+        assert client_init.call_args.kwargs['limits'] is DEFAULT_LIMITS
+
+        limits = httpx.Limits(max_connections=10)
+        NoteableClient('fake-token', config=client_config, limits=limits)
+        assert client_init.call_args.kwargs['limits'] is limits
+
+
+@pytest.mark.asyncio
+async def test_client_fetches_token_on_context_entry(connect_mock_with_auth_patched, client_config):
+    token = Token(access_token='fetched-token')
+    with patch.object(NoteableClient, 'get_token', new_callable=AsyncMock) as get_token:
+        get_token.return_value = token
+        client = NoteableClient(config=client_config)
+        get_token.assert_not_called()
+        async with client:
+            get_token.assert_awaited_once()
+            assert client.token is token
+            assert client.headers['authorization'] == 'Bearer fetched-token'
+
+
+@pytest.mark.asyncio
+async def test_client_reuses_cached_token(client_config):
+    cache_key = (client_config.auth0_domain, client_config.client_id, client_config.audience)
+    token = Token(
+        access_token='cached-token', exp=datetime.now(timezone.utc) + timedelta(minutes=5)
+    )
+    with patch.dict(TOKEN_CACHE, {cache_key: token}):
+        # The token is fetched through a separate bare client, so patch every client's post
+        with patch.object(httpx.AsyncClient, 'post', new_callable=AsyncMock) as post:
+            assert await NoteableClient(config=client_config).get_token() is token
+            post.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_client_concurrent_token_fetches_are_shared(client_config):
+    token_resp = httpx.Response(
+        200, json={'access_token': 'fetched-token'}, request=httpx.Request('POST', 'https://auth')
+    )
+
+    async def slow_post(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return token_resp
+
+    with patch.dict(TOKEN_CACHE, clear=True), patch(
+        'jwt.decode', return_value={}, create=True
+    ), patch.object(httpx.AsyncClient, 'post', side_effect=slow_post) as post:
+        tokens = await asyncio.gather(
+            *[NoteableClient(config=client_config).get_token() for _ in range(3)]
+        )
+
+    post.assert_called_once()
+    assert all(token is tokens[0] for token in tokens)
+    assert not TOKEN_FETCHES
+
+
+@pytest.mark.asyncio
+async def test_client_context_exit_clears_trackers(connect_mock_with_auth_patched, client_config):
+    client = NoteableClient('fake-token', config=client_config)
+    type_callbacks = client.type_callbacks
+    async with client:
+
+        async def noop(resp):
+            return resp
+
+        client.register_message_callback(noop, 'fake-channel', message_type='fake_event')
+        assert type_callbacks
+    assert client.type_callbacks is type_callbacks
+    assert not client.type_callbacks
+    assert not client.transaction_callbacks
+    assert client.subscriptions == {'system'}
+
+
+def test_token_expires_with_leeway():
+    now = datetime.now(timezone.utc)
+    assert Token(access_token='token').is_expired
+    assert Token(access_token='token', exp=now + TOKEN_EXPIRY_LEEWAY / 2).is_expired
+    assert not Token(access_token='token', exp=now + TOKEN_EXPIRY_LEEWAY * 2).is_expired
+
+
+@pytest.mark.asyncio
+async def test_client_token_request_omits_client_headers(client_config):
+    client = NoteableClient(config=client_config, headers={'X-Custom': 'secret'})
+    token_resp = httpx.Response(
+        200, json={'access_token': 'fetched-token'}, request=httpx.Request('POST', 'https://auth')
+    )
+    with patch.dict(TOKEN_CACHE, clear=True), patch(
+        'jwt.decode', return_value={}, create=True
+    ), patch.object(httpx.AsyncClient, 'post', autospec=True, return_value=token_resp) as post:
+        token = await client.get_token()
+
+    assert token.access_token == 'fetched-token'
+    auth_client = post.call_args.args[0]
+    assert auth_client is not client
+    assert 'x-custom' not in auth_client.headers
+
+
 @pytest.mark.asyncio
 async def test_client_ping(connect_mock, client):
     # The connect does a ping to ensure that the connection is healthy
@@ -109,6 +261,208 @@ async def test_client_subscribe(connect_mock, client):
     assert resp.channel == 'fake-channel'
 
 
+@pytest.mark.asyncio
+async def test_client_rtu_request_requires_context(client_config):
+    client = NoteableClient('fake-token', config=client_config)
+    with pytest.raises(ValueError):
+        await client.send_rtu_request(PingRequest(transaction_id=uuid4()))
+
+
+@pytest.mark.asyncio
+async def test_client_unsent_request_leaves_no_trackers(client_config):
+    client = NoteableClient('fake-token', config=client_config)
+    with pytest.raises(ValueError):
+        await client.subscribe_channel('fake-channel')
+    with pytest.raises(ValueError):
+        await client.ping_rtu()
+    with pytest.raises(ValueError):
+        await client.replace_cell_contents(NotebookFile.construct(id=uuid4()), 'cell-1', 'a = 1')
+    assert not client.transaction_callbacks
+    assert not client.type_callbacks
+
+
+@pytest.mark.asyncio
+async def test_client_sends_requests_in_order(connect_mock, client):
+    connect_mock.return_value.send.reset_mock(side_effect=True)
+    requests = [PingRequest(transaction_id=uuid4()) for _ in range(3)]
+    for req in requests:
+        await client.send_rtu_request(req)
+
+    sent = [
+        extract_msg_transaction_id(c.args[0]) for c in connect_mock.return_value.send.call_args_list
+    ]
+    assert sent == [req.transaction_id for req in requests]
+
+
+@pytest.mark.asyncio
+async def test_client_send_failure_reaches_caller(connect_mock, client):
+    connect_mock.return_value.send.side_effect = ConnectionClosedError(None, None)
+    with pytest.raises(ConnectionClosedError):
+        await client.ping_rtu()
+    assert not client.transaction_callbacks
+
+
+@pytest.mark.asyncio
+async def test_client_invalid_reply_fails_tracker(connect_mock, client):
+    async def noop(resp):
+        return resp
+
+    req_id = uuid4()
+    tracker = client.register_message_callback(
+        noop, 'fake-channel', transaction_id=req_id, response_schema=FileSubscribeReplySchema
+    )
+    # Missing the data fields required by the registered response schema
+    connect_mock.return_value.recv.return_value = GenericRTUReply(
+        msg_id=uuid4(),
+        transaction_id=req_id,
+        event='subscribe_reply',
+        channel='fake-channel',
+        data={"success": True},
+        processed_timestamp=datetime.now(),
+    ).json()
+
+    with pytest.raises(ValidationError):
+        await asyncio.wait_for(tracker.next_trigger, 1)
+    # The processing loop survives the bad payload
+    assert not client.process_task_loop.done()
+
+
+@pytest.mark.asyncio
+async def test_client_dispatches_requests_without_msg_id(connect_mock, client):
+    async def noop(resp):
+        return resp
+
+    tracker = client.register_message_callback(noop, 'fake-channel', message_type='fake_request')
+    connect_mock.return_value.recv.return_value = GenericRTURequest(
+        transaction_id=uuid4(), event='fake_request', channel='fake-channel'
+    ).json()
+
+    resp = await asyncio.wait_for(tracker.next_trigger, 1)
+    assert isinstance(resp, GenericRTURequest)
+
+
+@pytest.mark.asyncio
+async def test_client_trackers_registered_during_dispatch_wait_for_next_message(
+    connect_mock, client
+):
+    messages = asyncio.Queue()
+    connect_mock.return_value.recv.side_effect = messages.get
+    outer_calls = []
+    inner_calls = []
+
+    async def inner(resp):
+        inner_calls.append(resp)
+        return resp
+
+    async def outer(resp):
+        outer_calls.append(resp)
+        client.register_message_callback(inner, 'fake-channel', message_type='fake_event')
+        return resp
+
+    tracker = client.register_message_callback(
+        outer, 'fake-channel', message_type='fake_event', once=False
+    )
+
+    def fake_event():
+        return GenericRTUReply(
+            msg_id=uuid4(),
+            transaction_id=uuid4(),
+            event='fake_event',
+            channel='fake-channel',
+            processed_timestamp=datetime.now(),
+        ).json()
+
+    first_trigger = tracker.next_trigger
+    await messages.put(fake_event())
+    await asyncio.wait_for(first_trigger, 1)
+    await asyncio.sleep(0)
+    assert len(outer_calls) == 1
+    assert inner_calls == []
+
+    second_trigger = tracker.next_trigger
+    await messages.put(fake_event())
+    await asyncio.wait_for(second_trigger, 1)
+    await asyncio.sleep(0)
+    assert len(outer_calls) == 2
+    assert len(inner_calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_client_replace_cells(connect_mock, client):
+    file = NotebookFile.construct(id=uuid4())
+    replies = asyncio.Queue()
+    sent_cell_ids = []
+
+    async def delta_reply(msg):
+        sent_cell_ids.append(json.loads(msg)['data']['delta']['resource_id'])
+        await replies.put(
+            GenericRTUReply(
+                msg_id=uuid4(),
+                transaction_id=extract_msg_transaction_id(msg),
+                event='new_delta_reply',
+                channel=file.channel,
+                data={"success": True},
+                processed_timestamp=datetime.now(),
+            ).json()
+        )
+
+    connect_mock.return_value.send.side_effect = delta_reply
+    connect_mock.return_value.recv.side_effect = replies.get
+
+    resps = await client.replace_cells(file, [('cell-1', 'a = 1'), ('cell-2', 'b = 2')])
+    assert sent_cell_ids == ['cell-1', 'cell-2']
+    assert [resp.data.success for resp in resps] == [True, True]
+    assert not client.transaction_callbacks
+
+
+@pytest.mark.asyncio
+async def test_client_replace_cells_partial_failure(connect_mock, client):
+    file = NotebookFile.construct(id=uuid4())
+    replies = asyncio.Queue()
+
+    async def delta_reply(msg):
+        # Only the first cell gets a reply, the second times out
+        if json.loads(msg)['data']['delta']['resource_id'] == 'cell-1':
+            await replies.put(
+                GenericRTUReply(
+                    msg_id=uuid4(),
+                    transaction_id=extract_msg_transaction_id(msg),
+                    event='new_delta_reply',
+                    channel=file.channel,
+                    data={"success": True},
+                    processed_timestamp=datetime.now(),
+                ).json()
+            )
+
+    connect_mock.return_value.send.side_effect = delta_reply
+    connect_mock.return_value.recv.side_effect = replies.get
+
+    tasks_before = asyncio.all_tasks()
+    resps = await client.replace_cells(
+        file, [('cell-1', 'a = 1'), ('cell-2', 'b = 2')], timeout=0.1
+    )
+    assert resps[0].data.success
+    assert isinstance(resps[1], asyncio.TimeoutError)
+    assert not client.transaction_callbacks
+    # No reply waits are left running after the call returns
+    assert asyncio.all_tasks() <= tasks_before
+
+    with pytest.raises(asyncio.TimeoutError):
+        await client.replace_cell_contents(file, 'cell-2', 'b = 2', timeout=0.1)
+
+
+@pytest.mark.asyncio
+async def test_client_replace_cells_send_failure(connect_mock, client):
+    file = NotebookFile.construct(id=uuid4())
+    connect_mock.return_value.send.side_effect = ConnectionClosedError(None, None)
+
+    with pytest.raises(ConnectionClosedError):
+        await asyncio.wait_for(
+            client.replace_cells(file, [('cell-1', 'a = 1'), ('cell-2', 'b = 2')]), 1
+        )
+    assert not client.transaction_callbacks
+
+
 @pytest.mark.xfail(
     reason="AttributeError: 'str' object has no attribute 'current_version_id' in client.subscribe_file"
 )
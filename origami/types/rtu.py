@@ -528,11 +528,13 @@ RTU_MESSAGE_TYPES = {
     # "invalid_data",
 }
 
-RTU_ERROR_HARD_MESSAGE_TYPES = {
-    "malformed_request",
-    "channel_does_not_exist",
-    "permission_denied",
-    "unspecified_error",
-    "invalid_event",
-    "invalid_data",
-}
+RTU_ERROR_HARD_MESSAGE_TYPES = frozenset(
+    {
+        "malformed_request",
+        "channel_does_not_exist",
+        "permission_denied",
+        "unspecified_error",
+        "invalid_event",
+        "invalid_data",
+    }
+)